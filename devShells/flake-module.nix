@@ -26,6 +26,7 @@
         # sops dependencies
         pkgs.age
         pkgs.sops
+        pkgs.ssh-to-age
         pkgs.yq-go
       ] ++ pkgs.lib.optional (pkgs.stdenv.isLinux) pkgs.mkpasswd;
     };
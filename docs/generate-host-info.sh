@@ -15,7 +15,7 @@ elif [[ "$hostname" == sarah ]]; then
   scp "$1":/tmp/$hostname.lstopo.svg "$lstopo"
   ssh "$1" -- sudo rm /tmp/$hostname.lstopo.svg
 else
-  ssh "$1" -- nix-shell -p \'inxi.override { withRecommends = true\; }\' --run \"sudo inxi -F -a -i --slots -xxx -c0 -Z -i -m\" >> "$report"
+  ssh "$1" -- sudo inxi -F -a -i --slots -xxx -c0 -Z -i -m >> "$report"
   ssh "$1" -- nix-shell -p hwloc -p dmidecode --run \"sudo lstopo /tmp/$hostname.lstopo.svg\"
   scp "$1":/tmp/$hostname.lstopo.svg "$lstopo"
   ssh "$1" -- sudo rm /tmp/$hostname.lstopo.svg
@@ -30,6 +30,7 @@
     (neovim.override { vimAlias = true; })
 
     pciutils
+    dmidecode
     ethtool
     usbutils
     smartmontools # smartctl
@@ -37,6 +38,8 @@
     edac-utils # edac-util: memory/pci errors
 
     ipmitool
+    # used by `inv update-docs`
+    (inxi.override { withRecommends = true; })
     # tries to default to soft-float due to out-dated cc-rs
   ] ++ lib.optional (!stdenv.hostPlatform.isRiscV) bandwhich;
 }
@@ -1,15 +1,22 @@
 #!/usr/bin/env python3
 
+import atexit
+import functools
+import hashlib
 import json
 import os
 import random
+import re
+import shlex
 import shutil
+import socket
 import string
 import subprocess
 import sys
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import IO, Any, Callable, List
+from typing import IO, Any, Callable, Dict, List, Optional, Sequence, Set
 
 from deploykit import DeployGroup, DeployHost
 from invoke import task
@@ -17,17 +24,50 @@ from invoke import task
 ROOT = Path(__file__).parent.resolve()
 os.chdir(ROOT)
 
+# multiplex all ssh commands to a host over a single persistent connection
+# the control socket lives in ~/.ssh rather than the checkout, as unix socket
+# paths are limited to ~107 bytes and %C alone expands to 40 characters
+SSH_CONTROL_DIR = Path.home() / ".ssh"
+SSH_OPTIONS = {
+    "ControlMaster": "auto",
+    "ControlPath": f"{SSH_CONTROL_DIR}/cm-%C",
+    "ControlPersist": "600s",
+}
+SSH_OPTS = [arg for k, v in SSH_OPTIONS.items() for arg in ("-o", f"{k}={v}")]
+SSH_CONTROL_DIR.mkdir(mode=0o700, exist_ok=True)
 
-def get_hosts(hosts: str) -> List[DeployHost]:
-    return [DeployHost(h, user="root") for h in hosts.split(",")]
+_SSH_TARGETS: Set[str] = set()
 
 
-def deploy_nixos(hosts: List[DeployHost]) -> None:
+def ssh_host(host: str, **kwargs: Any) -> DeployHost:
     """
-    Deploy to all hosts in parallel
+    Create a DeployHost whose ssh connections are multiplexed via SSH_OPTIONS
     """
-    g = DeployGroup(hosts)
+    kwargs.setdefault("user", "root")
+    kwargs["ssh_options"] = {**SSH_OPTIONS, **kwargs.get("ssh_options", {})}
+    _SSH_TARGETS.add(f"{kwargs['user']}@{host}")
+    return DeployHost(host, **kwargs)
+
+
+@atexit.register
+def close_ssh_masters() -> None:
+    for target in _SSH_TARGETS:
+        subprocess.run(
+            ["ssh", *SSH_OPTS, "-O", "exit", target],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+
+def get_hosts(hosts: str) -> List[DeployHost]:
+    return [ssh_host(h) for h in hosts.split(",")]
+
 
+@functools.lru_cache(maxsize=1)
+def flake_path() -> str:
+    """
+    Store path of this flake, evaluated only once per invocation
+    """
     res = subprocess.run(
         ["nix", "flake", "metadata", "--json"],
         check=True,
@@ -35,18 +75,39 @@ def deploy_nixos(hosts: List[DeployHost]) -> None:
         stdout=subprocess.PIPE,
     )
     data = json.loads(res.stdout)
-    path = data["path"]
+    return data["path"]
+
+
+def deploy_nixos(hosts: List[DeployHost]) -> None:
+    """
+    Deploy to all hosts in parallel
+    """
+    g = DeployGroup(hosts)
+
+    path = flake_path()
 
     def deploy(h: DeployHost) -> None:
         target = f"{h.user or 'root'}@{h.host}"
-        flake_path = h.meta.get("flake_path", "/etc/nixos")
+        # copy the flake source as a store path, this is a no-op if the
+        # target already has it and needs no checksum scan of the tree
         h.run_local(
-            f"rsync --checksum -vaF --delete -e ssh {path}/ {target}:{flake_path}"
+            f"nix copy --to ssh-ng://{target} {path}",
+            extra_env={"NIX_SSHOPTS": " ".join(SSH_OPTS)},
+        )
+        # point flake_path (/etc/nixos by default) at the copied source, so
+        # a local nixos-rebuild on the host uses the deployed config. The
+        # link is registered as gc root to keep the source alive. A checkout
+        # from earlier rsync based deploys is replaced.
+        flake_dir = h.meta.get("flake_path", "/etc/nixos")
+        h.run(
+            f"if [ -d {flake_dir} ] && [ ! -L {flake_dir} ]; then rm -rf {flake_dir}; fi; "
+            f"nix-store --realise {path} --add-root {flake_dir} > /dev/null"
         )
 
+        flake = flake_dir
         flake_attr = h.meta.get("flake_attr")
         if flake_attr:
-            flake_path += "#" + flake_attr
+            flake += "#" + flake_attr
         cmd = [
             "nixos-rebuild",
             "switch",
@@ -55,7 +116,7 @@ def deploy_nixos(hosts: List[DeployHost]) -> None:
             "accept-flake-config",
             "true",
             "--flake",
-            flake_path,
+            flake,
             "--option",
             "keep-going",
             "true",
@@ -106,9 +167,9 @@ def flake_check(c: Any) -> None:
     """
     Run nix checks on this repo (may need a aarch64 remote builder configured)
     """
-    cmd = "nix flake check --option allow-import-from-derivation true"
-    print(f"$ {cmd}")
-    os.system(cmd)
+    cmd = ["nix", "flake", "check", "--option", "allow-import-from-derivation", "true"]
+    print(f"$ {shlex.join(cmd)}")
+    subprocess.run(cmd, check=True)
 
 
 def document_cards(hosts: DeployGroup) -> str:
@@ -119,40 +180,42 @@ def document_cards(hosts: DeployGroup) -> str:
     def get_slots(h: DeployHost) -> List[str]:
         ret = []
 
-        # get pci ids in the same order as inxi
-        dmi_slots = h.run(
-            "nix-shell -p 'dmidecode' --run \"sudo dmidecode -t slot\"",
+        # get pci ids in the same order as inxi and describe them with lspci,
+        # all within a single ssh invocation. dmidecode and lspci are
+        # installed by modules/packages.nix.
+        script = """
+set -o pipefail
+sudo dmidecode -t slot | while read -r line; do
+  case "$line" in
+    "System Slot Information"*) echo "===slot===" ;;
+    "Bus Address:"*) lspci -m -s "${line#Bus Address: }" ;;
+  esac
+done
+"""
+        slots = h.run(
+            ["bash", "-c", script],
             stdout=subprocess.PIPE,
             check=False,
         )
         # fails on our m1 aarch64 linux machine
-        if dmi_slots.returncode != 0:
+        if slots.returncode != 0:
             return []
-        for slot in dmi_slots.stdout.split("System Slot Information")[1:]:
-            description = ""
-            for line in slot.splitlines():
-                if "Bus Address" in line:
-                    pciid = line.split(": ")[1].strip()
-                    # get slot descriptions
-                    description = h.run(
-                        f"nix-shell -p 'pciutils' --run \"lspci -m -s {pciid}\"",
-                        stdout=subprocess.PIPE,
-                    )
-                    description = description.stdout.strip()
-                    description = description.replace(' "', ", ")
-                    description = description.replace('"', "")
+        for slot in slots.stdout.split("===slot===\n")[1:]:
+            description = slot.strip()
+            description = description.replace(' "', ", ")
+            description = description.replace('"', "")
             if len(description) == 0:
-                ret += ["No device/PCI ID."]
+                ret.append("No device/PCI ID.")
             else:
-                ret += [description]
+                ret.append(description)
         return ret
 
     def doc_cards(h: DeployHost) -> str:
-        result = ""
+        result = []
         descriptions = get_slots(h)
         descriptions.reverse()  # reverse so pop gives the first
         inxi_slots = h.run(
-            "nix-shell -p 'inxi.override { withRecommends = true; }' --run \"sudo inxi --slots -xxx -c0 --wrap-max 200\"",
+            "sudo inxi --slots -xxx -c0 --wrap-max 200",
             stdout=subprocess.PIPE,
         )
         for line in inxi_slots.stdout.splitlines():
@@ -164,30 +227,24 @@ def document_cards(hosts: DeployGroup) -> str:
             if "status: In Use" in line:
                 line = f"- ❌{line}"
                 is_device_line = True
-            result += f"{line}   \n"
+            result.append(f"{line}   \n")
             # print expansion card description
             if is_device_line:
                 if len(descriptions) == 0:
-                    result += "Error\n"
+                    result.append("Error\n")
                 else:
-                    result += f"{descriptions.pop()}  \n"
-        return f"### {h.host} \n\n{result} \n\n"
+                    result.append(f"{descriptions.pop()}  \n")
+        return f"### {h.host} \n\n{''.join(result)} \n\n"
 
     results = hosts.run_function(doc_cards)
-    results2 = list(
-        map(
-            lambda result: result.result,
-            list(sorted(results, key=lambda i: i.host.host)),
-        )
-    )
-    return "".join(results2)
+    return "".join(r.result for r in sorted(results, key=lambda r: r.host.host))
 
 
-def document_nixos(_hosts: List[str]) -> None:
+def document_nixos(_hosts: Sequence[str]) -> None:
     """
     Generate documentation, expects "hostname.r"
     """
-    hosts = DeployGroup([DeployHost(h, user="root") for h in _hosts])
+    hosts = DeployGroup([ssh_host(h) for h in _hosts])
 
     # generate per-host docs
     def doc_host(h: DeployHost) -> None:
@@ -205,11 +262,11 @@ Note that ubuntu workstations and servers don't appear in this list.
     (ROOT / "docs" / "expansion_cards_autogen.md").write_text(content)
 
 
-def get_lldp_neighbors(hosts: List[str]) -> None:
+def get_lldp_neighbors(hosts: Sequence[str]) -> None:
     """
     Get LLDP-discovered neighbors, expects "hostname.r"
     """
-    tum = DeployGroup([DeployHost(h, user="root") for h in HOSTS])
+    tum = DeployGroup([ssh_host(h) for h in HOSTS])
 
     def doc_tum(h: DeployHost) -> None:
         h.run_local(f"../../get-lldp-neighbors.sh {h.host}")
@@ -218,15 +275,18 @@ def get_lldp_neighbors(hosts: List[str]) -> None:
     os.chdir("docs/hosts")
     if not os.path.exists("lldp"):
         os.mkdir("lldp")
-    os.chdir("lldp")
-    tum.run_function(doc_tum)
-    os.system("../../generate-lldp-graph.sh")
-    os.chdir("..")
-    shutil.rmtree("lldp", ignore_errors=True)
-    os.chdir(pwd)
-
-
-HOSTS = [
+    try:
+        os.chdir("lldp")
+        tum.run_function(doc_tum)
+        subprocess.run(["../../generate-lldp-graph.sh"], check=True)
+    finally:
+        # don't leave partial lldp output in the repo, even on failure
+        os.chdir(ROOT / "docs" / "hosts")
+        shutil.rmtree("lldp", ignore_errors=True)
+        os.chdir(pwd)
+
+
+HOSTS = (
     "astrid.dos.cit.tum.de",
     "dan.dos.cit.tum.de",
     "mickey.dos.cit.tum.de",
@@ -245,7 +305,7 @@ HOSTS = [
     "amy.dos.cit.tum.de",
     "rose.dos.cit.tum.de",
     "vislor.dos.cit.tum.de",
-]
+)
 
 # used for different IPMI power readings
 MANUFACTURERS = dict(
@@ -277,6 +337,21 @@ MANUFACTURERS = dict(
 )
 
 
+def mgmt_hostname(hostname: str) -> str:
+    splits = hostname.split(".")
+    splits[0] = f"{splits[0]}-mgmt"
+    hostname = ".".join(splits)
+    return hostname
+
+
+# per-host IPMI details, keyed by short hostname
+HOST_META = {
+    hostname.split(".")[0]: dict(mgmt=mgmt_hostname(hostname), vendor=vendor)
+    for vendor, hostnames in MANUFACTURERS.items()
+    for hostname in hostnames
+}
+
+
 HAS_TTY = sys.stderr.isatty()
 
 
@@ -299,7 +374,7 @@ def deploy(c: Any) -> None:
     """
     Deploy to servers
     """
-    deploy_nixos([DeployHost(h, user="root") for h in HOSTS])
+    deploy_nixos([ssh_host(h) for h in HOSTS])
 
 
 @task
@@ -307,9 +382,8 @@ def deploy_ruby(c: Any) -> None:
     """
     Deploy to riscv server
     """
-    host = DeployHost(
+    host = ssh_host(
         "graham.dos.cit.tum.de",
-        user="root",
         forward_agent=True,
         command_prefix="ruby",
         meta=dict(
@@ -327,9 +401,8 @@ def deploy_doctor(c: Any) -> None:
     """
     Deploy to doctor
     """
-    host = DeployHost(
+    host = ssh_host(
         "localhost",
-        user="root",
         forward_agent=True,
         command_prefix="doctor",
         meta=dict(
@@ -347,7 +420,7 @@ def deploy_host(c: Any, host: str) -> None:
     """
     Deploy to a single host, i.e. inv deploy-host --host 192.168.1.2
     """
-    deploy_nixos([DeployHost(host, user="root")])
+    deploy_nixos([ssh_host(host)])
 
 
 @task
@@ -364,6 +437,7 @@ def update_docs(c: Any, hosts: str = "") -> None:
     """
     Regenerate docs for all servers
     """
+    host_list: Sequence[str]
     if hosts != "":
         host_list = hosts.split(",")
     else:
@@ -396,6 +470,7 @@ def update_lldp_info(c: Any, hosts: str = "") -> None:
     """
     Regenerate lldp info for all servers
     """
+    host_list: Sequence[str]
     if hosts != "":
         host_list = hosts.split(",")
     else:
@@ -484,12 +559,22 @@ def print_age_key(c: Any, host: str) -> None:
         check=True,
     )
     print("###### Age key ######")
-    subprocess.run(
-        ["nix", "run", "--inputs-from", ".#", "nixpkgs#ssh-to-age"],
-        input=proc.stdout,
-        check=True,
-        text=True,
+    print(ssh_to_age(proc.stdout))
+
+
+def ssh_to_age(pubkey: str) -> str:
+    """
+    Convert an ssh ed25519 public key to an age key. Uses ssh-to-age from the
+    dev shell and only falls back to `nix run` outside of it.
+    """
+    if shutil.which("ssh-to-age"):
+        cmd = ["ssh-to-age"]
+    else:
+        cmd = ["nix", "run", "--inputs-from", ".#", "nixpkgs#ssh-to-age"]
+    res = subprocess.run(
+        cmd, input=pubkey, check=True, text=True, stdout=subprocess.PIPE
     )
+    return res.stdout.rstrip()
 
 
 @task
@@ -544,11 +629,36 @@ def update_sops_files(c: Any) -> None:
     """
     Update all sops yaml and json files according to .sops.yaml rules
     """
-    with open(f"{ROOT}/.sops.yaml", "w") as f:
-        print("# AUTOMATICALLY GENERATED WITH:", file=f)
-        print("# $ inv update-sops-files", file=f)
-
-    c.run(f"nix eval --json -f {ROOT}/sops.yaml.nix | yq e -P - >> {ROOT}/.sops.yaml")
+    # only re-evaluate sops.yaml.nix if one of its inputs changed
+    inputs = hashlib.sha256()
+    for name in ["pubkeys.json", "sops.yaml.nix"]:
+        inputs.update((ROOT / name).read_bytes())
+    header = [
+        "# AUTOMATICALLY GENERATED WITH:",
+        "# $ inv update-sops-files",
+        f"# inputs: {inputs.hexdigest()}",
+    ]
+    sops_yaml = ROOT / ".sops.yaml"
+    if (
+        not sops_yaml.exists()
+        or sops_yaml.read_text().splitlines()[: len(header)] != header
+    ):
+        # generate the rules before writing anything, so a failed eval does
+        # not leave a .sops.yaml with a matching header but no rules behind
+        rules = subprocess.run(
+            ["nix", "eval", "--json", "-f", f"{ROOT}/sops.yaml.nix"],
+            check=True,
+            text=True,
+            stdout=subprocess.PIPE,
+        ).stdout
+        rules = subprocess.run(
+            ["yq", "e", "-P", "-"],
+            input=rules,
+            check=True,
+            text=True,
+            stdout=subprocess.PIPE,
+        ).stdout
+        sops_yaml.write_text("\n".join(header) + "\n" + rules)
     c.run(
         f"""
 find {ROOT} \
@@ -559,35 +669,84 @@ find {ROOT} \
         -type f \
         \( -iname '*.enc.json' -o -iname '*.yml' \) \
         -print0 | \
-        xargs -0 -n1 sops updatekeys --yes
+        xargs -0 -P 8 -n 8 sops updatekeys --yes
 """
     )
 
 
 def wait_for_host(host: str, shutdown: bool = False) -> None:
+    """
+    Wait until ssh on host stops (shutdown=True) or starts accepting connections
+    """
     import time
 
     while True:
-        res = subprocess.run(
-            ["ping", "-q", "-c", "1", "-w", "2", host], stdout=subprocess.DEVNULL
-        )
-        if shutdown:
-            if res.returncode == 1:
-                break
-        else:
-            if res.returncode == 0:
-                break
+        try:
+            with socket.create_connection((host, 22), timeout=2):
+                up = True
+        except OSError:
+            up = False
+        if up != shutdown:
+            break
         time.sleep(1)
-        sys.stdout.write(".")
-        sys.stdout.flush()
 
 
-def ipmi_password(c: Any) -> str:
-    return c.run(
-        """sops -d --extract '["ipmi-passwords"]' secrets.yml""", hide=True
+@functools.lru_cache(maxsize=1)
+def _ipmi_password() -> str:
+    return subprocess.run(
+        ["sops", "-d", "--extract", '["ipmi-passwords"]', "secrets.yml"],
+        check=True,
+        text=True,
+        stdout=subprocess.PIPE,
     ).stdout
 
 
+@functools.lru_cache(maxsize=1)
+def ipmi_password_file() -> str:
+    """
+    Write the IPMI password to a file only readable by us, so it does not
+    show up in the process list. The file is removed on exit.
+    """
+    fd, path = tempfile.mkstemp(prefix="ipmi-password-")
+    with os.fdopen(fd, "w") as f:
+        f.write(_ipmi_password())
+    atexit.register(os.unlink, path)
+    return path
+
+
+def sops_set(
+    c: Any, sops_file: str, values: Dict[str, str], replace: bool = False
+) -> None:
+    """
+    Set multiple top-level keys of a sops file with a single decrypt/encrypt
+    cycle by using yq as the editor of `sops <file>`. With replace=True all
+    other keys are dropped, which also creates new files without writing
+    their plaintext anywhere but sops' own temporary directory.
+    """
+    # sops would create a missing file from its example document, which the
+    # merge below would keep
+    if not replace and not os.path.exists(sops_file):
+        warn(f"{sops_file} does not exist")
+        sys.exit(1)
+    op = "=" if replace else "*"
+    editor = f"yq e -i '. {op} (strenv(SOPS_VALUES) | from_yaml)'"
+    res = c.run(
+        f"sops {sops_file}",
+        # newer sops prefer SOPS_EDITOR over EDITOR
+        env={
+            "SOPS_EDITOR": editor,
+            "EDITOR": editor,
+            "SOPS_VALUES": json.dumps(values),
+        },
+        warn=True,
+    )
+    # sops exits with 200 if the file has not changed, i.e. all values were
+    # already set
+    if res.exited not in (0, 200):
+        warn(f"sops failed to update {sops_file} (exit code {res.exited})")
+        sys.exit(1)
+
+
 @task
 def generate_password(c: Any, user: str = "root") -> None:
     """
@@ -623,17 +782,35 @@ def add_server(c: Any, hostname: str) -> None:
 
     print(f"Adding {hostname}")
 
-    keys = None
-    with open(f"{ROOT}/pubkeys.json", "r") as f:
-        keys = f.read()
-    keys = json.loads(keys)
+    pubkeys = ROOT / "pubkeys.json"
+    keys = json.loads(pubkeys.read_text())
     if keys["machines"].get(hostname, None):
         print("Configuration already exists")
         exit(-1)
-    keys["machines"][hostname] = ""
-    with open(f"{ROOT}/pubkeys.json", "w") as f:
-        json.dump(keys, f, indent=2)
 
+    # generate host keys first, so the age key of the host is known before
+    # pubkeys.json and all sops files are updated in a single pass
+    print("Generating SSH host keys")
+    host_keys: Dict[str, str] = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for keytype in ["rsa", "ed25519"]:
+            privkey = Path(f"{tmpdir}/ssh_host_{keytype}_key")
+            pubkey = Path(f"{tmpdir}/ssh_host_{keytype}_key.pub")
+            # create host key with comment -c and empty passphrase -N ''
+            c.run(
+                f"ssh-keygen -f {privkey} -t {keytype} -C 'host key for host {hostname}' -N ''"
+            )
+            host_keys[privkey.name] = privkey.read_text()
+            host_keys[pubkey.name] = pubkey.read_text()
+
+    print("Generating age key")
+    age = ssh_to_age(host_keys["ssh_host_ed25519_key.pub"])
+
+    print("Updating pubkeys.json")
+    keys["machines"][hostname] = age
+    pubkeys.write_text(json.dumps(keys, indent=2))
+
+    print("Updating sops files")
     update_sops_files(c)
 
     sops_file = f"{ROOT}/hosts/{hostname}.yml"
@@ -645,43 +822,24 @@ def add_server(c: Any, hostname: str) -> None:
     passwd_hash = subprocess.check_output(
         ["mkpasswd", "-m", "sha-512", "-s"], input=passwd, text=True
     )
-    with open(sops_file, "w") as hosts:
-        hosts.write(f"root-password: {passwd}\n")
-        hosts.write(f"root-password-hash: {passwd_hash}")
-    enc_out = subprocess.check_output(["sops", "-e", f"{sops_file}"], text=True)
-    with open(sops_file, "w") as hosts:
-        hosts.write(enc_out)
+    sops_set(
+        c,
+        sops_file,
+        {
+            "root-password": passwd,
+            "root-password-hash": passwd_hash.rstrip(),
+            **host_keys,
+        },
+        replace=True,
+    )
 
+    # host keys already exist in the sops file, so this only signs them
     print("Generating SSH certificate")
     generate_ssh_cert(c, hostname)
 
     print("Generating Tinc key")
     generate_tinc_key(c, hostname)
 
-    print("Generating age key")
-    key_ed = subprocess.Popen(
-        ["sops", "--extract", '["ssh_host_ed25519_key.pub"]', "-d", sops_file],
-        stdout=subprocess.PIPE,
-    )
-
-    age = subprocess.check_output(
-        ["nix", "run", "--inputs-from", ".#", "nixpkgs#ssh-to-age"],
-        text=True,
-        stdin=key_ed.stdout,
-    )
-    age = age.rstrip()
-
-    print("Updating pubkeys.json")
-    keys = None
-    with open(f"{ROOT}/pubkeys.json", "r") as f:
-        keys = json.load(f)
-    keys["machines"][hostname] = age
-    with open(f"{ROOT}/pubkeys.json", "w") as f:
-        json.dump(keys, f, indent=2)
-
-    print("Updating sops files")
-    update_sops_files(c)
-
     example_host_config = f"""
 {{
   imports = [
@@ -693,8 +851,7 @@ def add_server(c: Any, hostname: str) -> None:
   system.stateVersion = "22.11";
 }}"""
     print(f"Writing example hosts/{hostname}.nix")
-    with open(f"{ROOT}/hosts/{hostname}.nix", "w") as f:
-        f.write(example_host_config)
+    (ROOT / "hosts" / f"{hostname}.nix").write_text(example_host_config)
 
     c.run(
         "git add "
@@ -707,10 +864,33 @@ def add_server(c: Any, hostname: str) -> None:
     )
 
 
-def ipmitool(c: Any, host: str, cmd: str) -> subprocess.CompletedProcess:
-    return c.run(
-        f"""ipmitool -I lanplus -H {host} -U ADMIN -P '{ipmi_password(c)}' {cmd}""",
-        pty=True,
+# ipmitool command and pattern for the power reading of each vendor, other
+# vendors are not measured
+POWER_READINGS = {
+    # ipmitool -I lanplus -H 172.24.90.7 -U ADMIN -a sensor get Pwr\ Consumption
+    "dell": (
+        "sensor get Pwr\\ Consumption",
+        re.compile(r"Sensor Reading\s*:\s*(\d+)"),
+    ),
+    # ipmitool -I lanplus -H 172.24.90.7 -U ADMIN -a dcmi power reading
+    "supermicro": (
+        "dcmi power reading",
+        re.compile(r"Instantaneous power reading:\s*(\d+)"),
+    ),
+}
+
+
+def ipmitool(
+    c: Any, host: str, cmd: str, stdout: Optional[int] = None
+) -> subprocess.CompletedProcess:
+    # without stdout=subprocess.PIPE ipmitool inherits our terminal, which
+    # also makes interactive commands like `sol activate` work
+    return subprocess.run(
+        ["ipmitool", "-I", "lanplus", "-H", host, "-U", "ADMIN"]
+        + ["-f", ipmi_password_file(), *shlex.split(cmd)],
+        check=True,
+        text=True,
+        stdout=stdout,
     )
 
 
@@ -729,46 +909,33 @@ def ipmi_powerconsumption(c: Any) -> None:
     Measure the power consumption of our servers via IPMI. Note that this does not include all servers.
     """
 
-    def mgmt_hostname(hostname: str) -> str:
-        splits = hostname.split(".")
-        splits[0] = f"{splits[0]}-mgmt"
-        hostname = ".".join(splits)
-        return hostname
+    def read_power(meta: Dict[str, str]) -> int:
+        cmd, reading = POWER_READINGS[meta["vendor"]]
+        res = ipmitool(c, meta["mgmt"], cmd, stdout=subprocess.PIPE)
+        match = reading.search(res.stdout)
+        if match is None:
+            warn(f"no power reading in output of {meta['mgmt']}:\n{res.stdout}")
+            sys.exit(1)
+        return int(match.group(1))
 
-    total = 0
-    hosts = []
+    measured = {
+        host: meta
+        for host, meta in HOST_META.items()
+        if meta["vendor"] in POWER_READINGS
+    }
 
-    # dell:
-    # ipmitool -I lanplus -H 172.24.90.7 -U ADMIN -a sensor get Pwr\ Consumption
-    for hostname in MANUFACTURERS["dell"]:
-        hosts += [hostname.split(".")[0]]
-        hostname = mgmt_hostname(hostname)
-        print(hostname)
-        res = ipmitool(c, hostname, "sensor get Pwr\\ Consumption")
-        reading = [
-            line for line in res.stdout.splitlines() if "Sensor Reading" in line
-        ][0]
-        reading = reading.strip().split(":")[1].strip().split(" ")[0]
-        total += int(reading)
-        print(f"  {reading} Watts")
-        print("")
+    # every BMC is a separate device, so query all of them at once; write
+    # the password file upfront so the threads don't race to create it
+    ipmi_password_file()
+    with ThreadPoolExecutor(max_workers=len(measured)) as executor:
+        readings = list(executor.map(read_power, measured.values()))
 
-    # supermicro:
-    # ipmitool -I lanplus -H 172.24.90.7 -U ADMIN -a dcmi power reading
-    for hostname in MANUFACTURERS["supermicro"]:
-        hosts += [hostname.split(".")[0]]
-        hostname = mgmt_hostname(hostname)
-        print(hostname)
-        res = ipmitool(c, hostname, "dcmi power reading")
-        reading = [
-            line
-            for line in res.stdout.splitlines()
-            if "Instantaneous power reading:" in line
-        ][0]
-        reading = reading.strip().split(":")[1].strip().split(" ")[0]
-        total += int(reading)
+    for meta, reading in zip(measured.values(), readings):
+        print(meta["mgmt"])
         print(f"  {reading} Watts")
         print("")
+    hosts = list(measured)
+    total = sum(readings)
 
     print("")
     print(f"  Measured hosts: {hosts}")
@@ -819,7 +986,7 @@ def run(c: Any, command: str, hosts: str = "") -> None:
     Run provided command on the given hosts, if no host list is provided, than the command is run on all hosts.
     """
     if hosts == "":
-        g = DeployGroup([DeployHost(h, user="root") for h in HOSTS])
+        g = DeployGroup([ssh_host(h) for h in HOSTS])
     else:
         g = DeployGroup(get_hosts(hosts))
     g.run(command)
@@ -830,29 +997,24 @@ def reboot(c: Any, hosts: str = "") -> None:
     """
     Reboot hosts. example usage: fab --hosts clara.r,donna.r reboot
     """
-    deploy_hosts = [DeployHost(h, user="root") for h in hosts.split(",")]
-    for h in deploy_hosts:
-        g = DeployGroup([h])
-        g.run("reboot &")
+    deploy_hosts = [ssh_host(h) for h in hosts.split(",")]
+    DeployGroup(deploy_hosts).run("reboot &")
 
-        print(f"Wait for {h.host} to shutdown", end="")
-        sys.stdout.flush()
+    def wait_for_reboot(h: DeployHost) -> None:
         wait_for_host(h.host, shutdown=True)
-        print("")
-
-        print(f"Wait for {h.host} to start", end="")
-        sys.stdout.flush()
+        print(f"{h.host} is down, wait for it to start")
         wait_for_host(h.host)
-        print("")
+        print(f"{h.host} is up")
+
+    print(f"Wait for {len(deploy_hosts)} host(s) to reboot")
+    with ThreadPoolExecutor(max_workers=len(deploy_hosts)) as executor:
+        list(executor.map(wait_for_reboot, deploy_hosts))
 
 
 @task
 def cleanup_gcroots(c: Any, hosts: str = "") -> None:
-    deploy_hosts = [DeployHost(h, user="root") for h in hosts.split(",")]
-    for h in deploy_hosts:
-        g = DeployGroup([h])
-        g.run("find /nix/var/nix/gcroots/auto -type s -delete")
-        g.run("systemctl restart nix-gc")
+    g = DeployGroup(get_hosts(hosts))
+    g.run("find /nix/var/nix/gcroots/auto -type s -delete && systemctl restart nix-gc")
 
 
 @task
@@ -867,21 +1029,33 @@ def update_host_keys(c: Any, hosts: str = "") -> None:
         "ssh_host_rsa_key.pub",
     ]
     if hosts == "":
-        g = DeployGroup([DeployHost(h, user="root") for h in HOSTS])
+        g = DeployGroup([ssh_host(h) for h in HOSTS])
     else:
         g = DeployGroup(get_hosts(hosts))
-    for key in key_files:
-        results = g.run(f"cat /etc/ssh/{key}", stdout=subprocess.PIPE)
-        for result in results:
-            hostname = result.host.host.split(".")[0]
-            sops_file = f"{ROOT}/hosts/{hostname}.yml"
-            c.run(
-                f"sops --set '[\"{key}\"] {json.dumps(result.result.stdout)}' {sops_file}"
-            )
+    # fetch all keys with a single command per host, each prefixed by a marker
+    script = f"""
+set -euo pipefail
+for key in {" ".join(key_files)}; do
+  echo "==$key=="
+  cat "/etc/ssh/$key"
+done
+"""
+    results = g.run(["bash", "-c", script], stdout=subprocess.PIPE)
+    for result in results:
+        hostname = result.host.host.split(".")[0]
+        parts = re.split(r"^==(\S+)==\n", result.result.stdout, flags=re.MULTILINE)
+        # parts = ["", key1, content1, key2, content2, ...]
+        values = dict(zip(parts[1::2], parts[2::2]))
+        # never overwrite a key in the sops file with an empty value
+        missing = [key for key in key_files if not values.get(key)]
+        if missing:
+            warn(f"[{result.host.host}] could not read {', '.join(missing)}")
+            sys.exit(1)
+        sops_set(c, f"{ROOT}/hosts/{hostname}.yml", values)
 
 
 def get_k3s_kubeconfig(c: Any) -> None:
-    master = DeployHost("astrid.dos.cit.tum.de", user="root")
+    master = ssh_host("astrid.dos.cit.tum.de")
     admin_kubeconfig = master.run(
         "cat /etc/rancher/k3s/k3s.yaml", stdout=subprocess.PIPE
     )
@@ -897,12 +1071,11 @@ def get_k3s_kubeconfig(c: Any) -> None:
 
 @task
 def reset_k3s_cluster(c: Any) -> None:
-    master = DeployHost("astrid.dos.cit.tum.de", user="root")
+    master = ssh_host("astrid.dos.cit.tum.de")
     master.run("k3s-reset-node")
 
     agent_hosts = [
-        DeployHost(h, user="root")
-        for h in ["dan.dos.cit.tum.de", "mickey.dos.cit.tum.de"]
+        ssh_host(h) for h in ["dan.dos.cit.tum.de", "mickey.dos.cit.tum.de"]
     ]
     agents = DeployGroup(agent_hosts)
     agents.run("k3s-reset-node")